@@ -23,6 +23,9 @@
 import os
 import subprocess
 import dataclasses
+import functools
+import pathlib
+import types
 import argparse
 import logging
 import shutil
@@ -43,7 +46,21 @@ class _Binfmt:
     magic: str
     mask: str
 
-_BINFMT_DB = {
+    @functools.cached_property
+    def magic_hex(self) -> bytes:
+        """
+        The magic number pattern as shown by binfmt_misc (without the \\x escapes).
+        """
+        return self.magic.replace(r"\x", "").encode()
+
+    @functools.cached_property
+    def mask_hex(self) -> bytes:
+        """
+        The mask pattern as shown by binfmt_misc (without the \\x escapes).
+        """
+        return self.mask.replace(r"\x", "").encode()
+
+_BINFMT_DB = types.MappingProxyType({
     binfmt.arch: binfmt
     for binfmt in [
         _Binfmt(
@@ -59,7 +76,9 @@ _BINFMT_DB = {
             mask=r"\xff\xff\xff\xff\xff\xff\xff\x00\xff\xff\xff\xff\xff\xff\xff\xff\xfe\xff\xff\xff",
         ),
     ]
-}
+})
+
+_BINFMT_ARCHS = tuple(sorted(_BINFMT_DB))
 
 _logger = logging.getLogger("install-binfmt")
 
@@ -97,19 +116,19 @@ def _check_binfmt(mount_path: str, binfmt: _Binfmt, interpreter_path: str) -> bo
     if os.path.exists(binfmt_path):
         _logger.info(":: Found existent %s binfmt handler", binfmt.name)
 
-        with open(binfmt_path) as binfmt_file:
-            current_params: dict[str, str] = dict(
-                (row.split(" ", 1) + [""])[:2]
-                for row in filter(None, binfmt_file.read().split("\n"))
-            )
-            _logger.debug(":: Current configuration: %s", current_params)
+        current_params: dict[bytes, bytes] = {}
+        for row in pathlib.Path(binfmt_path).read_bytes().split(b"\n"):
+            if row:
+                (key, _, value) = row.partition(b" ")
+                current_params[key] = value
+        _logger.debug(":: Current configuration: %s", current_params)
 
         mismatch = "\n".join(
-            f"  - Current {name} {current!r} != expected {expected!r}"
+            f"  - Current {name} {current.decode()!r} != expected {expected.decode()!r}"
             for (name, current, expected) in [
-                ("magic", current_params.get("magic", "").replace("454c46", "ELF"), binfmt.magic.replace(r"\x", "")),
-                ("mask", current_params.get("mask", ""), binfmt.mask.replace(r"\x", "")),
-                ("interpreter", current_params.get("interpreter"), interpreter_path),
+                ("magic", current_params.get(b"magic", b"").replace(b"454c46", b"ELF"), binfmt.magic_hex),
+                ("mask", current_params.get(b"mask", b""), binfmt.mask_hex),
+                ("interpreter", current_params.get(b"interpreter", b""), os.fsencode(interpreter_path)),
             ]
             if current != expected
         )
@@ -168,7 +187,7 @@ def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--mount", action="store_true", help="Mount binfmt_misc")
     parser.add_argument("--binfmt-misc", default="/proc/sys/fs/binfmt_misc", help="Path to binfmt_misc")
-    parser.add_argument("arch", choices=sorted(_BINFMT_DB))
+    parser.add_argument("arch", choices=_BINFMT_ARCHS)
     parser.add_argument("interpreter")
     parser.add_argument("-d", "--debug", action="store_const", const=logging.DEBUG, dest="log_level")
     parser.set_defaults(log_level=logging.INFO)
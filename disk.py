@@ -25,8 +25,19 @@ import os
 import re
 import subprocess
 import dataclasses
+import functools
 import shutil
-import dask
+
+_PARAM_RE = re.compile(r"(\w+)=(\S+)")
+
+_SIZE_RE = re.compile(r"([\d.]+)\s*([a-z]*)")
+
+_SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    **{f"{prefix}{suffix}": 1000 ** power for (power, prefix) in enumerate("kmgtp", 1) for suffix in ["", "b"]},
+    **{f"{prefix}i{suffix}": 1024 ** power for (power, prefix) in enumerate("kmgtp", 1) for suffix in ["", "b"]},
+}
 
 @dataclasses.dataclass(frozen=True)
 class _Mkfs:
@@ -41,6 +52,22 @@ class _Mkfs:
     begin: int
     end: int
 
+def _parse_bytes(size: str) -> int:
+    """
+    Parses a human-readable size like 100MiB or 1.5GB into bytes.
+
+    Args:
+        size: The size string. Units are case-insensitive, KiB/MiB/... are binary
+            and kB/MB/... are decimal, as in parted.
+
+    Returns:
+        The size in bytes.
+    """
+    match = _SIZE_RE.fullmatch(size.strip().lower())
+    if match is None or match.group(2) not in _SIZE_UNITS:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
 def _parse_script(script: str) -> tuple[list[list[str]], list[_Mkfs]]:
     """
     Parses the script and extracts the parted commands and filesystem parameters.
@@ -54,41 +81,55 @@ def _parse_script(script: str) -> tuple[list[list[str]], list[_Mkfs]]:
     parted: list[list[str]] = []
     filesystems: list[_Mkfs] = []
     npart = 1
-    for line in filter(None, script.split("\n")):
-        left: list[str]
-        (left, right) = (line.split("#", 1) + [""])[:2]  # type: ignore
-        left = left.split()  # type: ignore
+    for line in filter(None, script.splitlines()):
+        (left_str, _, right) = line.partition("#")
+        left = left_str.split()
         if "mkpart" in left and ("primary" in left or "logical" in left):
             assert len(left) >= 5, f"Too short mkpart command: {left}"
-            params = dict(re.findall(r"(\w+)=([^\s]+)", right))
+            params = dict(_PARAM_RE.findall(right))
             filesystems.append(_Mkfs(
                 npart=npart,
                 fs=left[2],
                 label=params.get("label", ""),
                 reserved=params.get("reserved", ""),
                 mount=params.get("mount", ""),
-                begin=dask.utils.parse_bytes(left[3]),
-                end=(0 if left[4] == "100%" else dask.utils.parse_bytes(left[4])),
+                begin=_parse_bytes(left[3]),
+                end=(0 if left[4] == "100%" else _parse_bytes(left[4])),
             ))
             npart += 1
         parted.append(left)
     return (parted, filesystems)
 
 
-def _make_partition(path: str, npart: int) -> str:
+def _make_partition_prefix(path: str) -> str:
     """
-    Creates the partition path based on the device path and partition number.
+    Creates the prefix of the partition paths based on the device path.
 
     Args:
         path: The device path.
-        npart: The partition number.
 
     Returns:
-        The partition path.
+        The partition path without the partition number.
     """
     device = os.path.basename(path)
-    return (f"{path}p{npart}" if device.startswith(("mmcblk", "loop")) else f"{path}{npart}")
+    return (f"{path}p" if device.startswith(("mmcblk", "loop", "nvme")) else path)
+
 
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> str:
+    """
+    Resolves the command name to an executable path, caching the result.
+
+    Args:
+        name: The command name.
+
+    Returns:
+        The path of the executable.
+    """
+    executable = shutil.which(name)
+    if executable is None:
+        raise FileNotFoundError(f"Command not found: {name}")
+    return executable
 
 def _run_commands(cmds: list[list[str]]) -> None:
     """
@@ -101,9 +142,7 @@ def _run_commands(cmds: list[list[str]]) -> None:
         print(f"CMD [ {sys.argv[0]} ] ==>", " ".join(cmd))
         sys.stdout.flush()
         try:
-            executable = shutil.which(cmd[0])
-            if executable is None:
-                raise FileNotFoundError(f"Command not found: {cmd[0]}")
+            executable = (cmd[0] if os.path.isabs(cmd[0]) else _which(cmd[0]))
             subprocess.run([executable, *cmd[1:]], check=True)
         except subprocess.CalledProcessError:
             raise SystemExit(1)
@@ -112,15 +151,17 @@ def _format_disk(device_path: str) -> None:
     """
     Formats the disk using the parted commands.
 
+    Note: All the commands are passed to a single parted call, so the partition
+    table is read and written only once.
+
     Args:
         device_path: The path of the disk device.
     """
     (parted, _) = _parse_script(sys.stdin.read())
     cmds: list[list[str]] = []
-    for cmd in parted:
-        cmds.append([shutil.which("parted"), device_path, "-a", "optimal", "-s", *cmd])
-    cmds.append([shutil.which("partprobe"), device_path])
-    cmds.append([shutil.which("partx"), "-vu", device_path])
+    cmds.append([_which("parted"), device_path, "-a", "optimal", "-s", *[arg for cmd in parted for arg in cmd]])
+    cmds.append([_which("partprobe"), device_path])
+    cmds.append([_which("partx"), "-vu", device_path])
     _run_commands(cmds)
 
 def _mkfs_disk(device_path: str) -> None:
@@ -131,25 +172,26 @@ def _mkfs_disk(device_path: str) -> None:
         device_path: The path of the disk device.
     """
     (_, filesystems) = _parse_script(sys.stdin.read())
+    part_prefix = _make_partition_prefix(device_path)
     cmds: list[list[str]] = []
     for mkfs in filesystems:
         cmd: list[str] = []
         if mkfs.fs == "fat32":
-            cmd.append(shutil.which("mkfs.vfat"))
+            cmd.append(_which("mkfs.vfat"))
             if mkfs.label:
                 cmd.extend(["-n", mkfs.label])
         elif mkfs.fs == "ext4":
-            cmd.append(shutil.which("mkfs.ext4"))
+            cmd.append(_which("mkfs.ext4"))
             if mkfs.label:
                 cmd.extend(["-L", mkfs.label])
             if mkfs.reserved:
                 cmd.extend(["-m", mkfs.reserved])
         else:
             raise RuntimeError(f"Unsupported filesystem: {mkfs.fs}")
-        cmd.append(_make_partition(device_path, mkfs.npart))
+        cmd.append(f"{part_prefix}{mkfs.npart}")
         cmds.append(cmd)
-    cmds.append([shutil.which("partprobe"), device_path])
-    cmds.append([shutil.which("partx"), "-vu", device_path])
+    cmds.append([_which("partprobe"), device_path])
+    cmds.append([_which("partx"), "-vu", device_path])
     _run_commands(cmds)
 
 def _mount_disk(device_path: str, prefix_path: str, mount: bool) -> None:
@@ -160,22 +202,29 @@ def _mount_disk(device_path: str, prefix_path: str, mount: bool) -> None:
         device_path: The path of the disk device.
         prefix_path: The prefix path for mounting the partitions.
         mount: True to mount, False to unmount.
+
+    Note: Partitions are mounted one by one, shallowest first, stopping at the first
+    failure. Nested mountpoints can only be created after their parent is mounted,
+    so they are created by mount itself (X-mount.mkdir). All partitions are unmounted
+    by a single umount call, which processes its arguments in order, deepest first.
     """
     (_, filesystems) = _parse_script(sys.stdin.read())
-    cmds: list[list[str]] = []
     filesystems = sorted(filesystems, key=(lambda mkfs: len(list(filter(None, mkfs.mount.split("/"))))))
     if not mount:
         filesystems.reverse()
-    for mkfs in filesystems:
-        if mkfs.mount:
-            part_path = _make_partition(device_path, mkfs.npart)
-            if mount:
-                mount_path = prefix_path + "/" + mkfs.mount
-                cmds.append([shutil.which("mkdir"), "-p", mount_path])
-                cmds.append([shutil.which("mount"), part_path, mount_path])
-            else:
-                cmds.append([shutil.which("umount"), part_path])
-    _run_commands(cmds)
+    filesystems = [mkfs for mkfs in filesystems if mkfs.mount]
+    if not filesystems:
+        return
+    part_prefix = _make_partition_prefix(device_path)
+    if mount:
+        prefix_path = os.path.abspath(prefix_path)
+        os.makedirs(prefix_path, exist_ok=True)
+        _run_commands([
+            [_which("mount"), "-o", "X-mount.mkdir", f"{part_prefix}{mkfs.npart}", prefix_path + "/" + mkfs.mount]
+            for mkfs in filesystems
+        ])
+    else:
+        _run_commands([[_which("umount"), *[f"{part_prefix}{mkfs.npart}" for mkfs in filesystems]]])
 
 def _print_size() -> None:
     """
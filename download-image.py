@@ -1,22 +1,80 @@
 #!/usr/bin/env python3
 import argparse
-from bs4 import BeautifulSoup
+import concurrent.futures
+import hashlib
+import json
 import logging
 import os
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
 
-def _run(cmd: list[str], input: (str | None) = None, read: bool = False) -> str:
+_DIR_HREF_RE = re.compile(rb'href="([^"?/][^"]*/)"')
+_XZ_HREF_RE = re.compile(rb'href="([^"]+\.xz)"')
+
+# requests.Session is not thread-safe, so each download worker gets its own
+_LOCAL = threading.local()
+
+_TIMEOUT = 30
+
+# The images are already compressed, don't let the server wrap them in gzip again
+_IDENTITY_ENCODING = {'Accept-Encoding': 'identity'}
+
+def _session() -> requests.Session:
+    """
+    Get the HTTP session of the current thread, creating it on first use.
+
+    The session is reused for all requests of a download, so requests to the same
+    mirror share the connection, and retries failed connections with a backoff.
+
+    Returns:
+        requests.Session: The session of the current thread.
+    """
+    session = getattr(_LOCAL, 'session', None)
+    if session is None:
+        session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            session.mount(prefix, HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5)))
+        _LOCAL.session = session
+    return session
+
+def _run(cmd: list[str]) -> None:
+    """
+    Run a command, passing its output straight through to our stdout.
+
+    Args:
+        cmd (list[str]): The command to run.
+
+    Raises:
+        SystemExit: If the command returns a non-zero exit code.
+    """
+    print(f"CMD [ {sys.argv[0]} ] ==>", " ".join(cmd))
+    sys.stdout.flush()
+    retcode = subprocess.call(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=sys.stdout,
+        stderr=sys.stderr,
+        process_group=0,
+    )
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if retcode != 0:
+        raise SystemExit(1)
+
+def _run_capture(cmd: list[str]) -> str:
     """
     Run a command and return the output.
 
     Args:
         cmd (list[str]): The command to run.
-        input (str | None): The input to pass to the command (optional).
-        read (bool): Whether to read and return the command output (default: False).
 
     Returns:
         str: The output of the command.
@@ -26,21 +84,49 @@ def _run(cmd: list[str], input: (str | None) = None, read: bool = False) -> str:
     """
     print(f"CMD [ {sys.argv[0]} ] ==>", " ".join(cmd))
     sys.stdout.flush()
-    proc = subprocess.Popen(
+    proc = subprocess.run(
         cmd,
-        stdin=(None if input is None else subprocess.PIPE),
-        stdout=(subprocess.PIPE if read else sys.stdout),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
         stderr=sys.stderr,
-        preexec_fn=os.setpgrp,
+        process_group=0,
     )
-    data = proc.communicate(None if input is None else input.encode())[0]
-    retcode = proc.poll()
     sys.stdout.flush()
     sys.stderr.flush()
-    if retcode != 0:
+    if proc.returncode != 0:
         raise SystemExit(1)
-    return (data.decode().strip() if read else "")
+    return proc.stdout.decode().strip()
+
 
+class _HashingWriter:
+    """
+    A file-like wrapper that computes the SHA-256 of everything written through it.
+
+    Attributes:
+        file: The underlying binary file object.
+        hash: The running hashlib SHA-256 object.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+def _chown_tree(path, uid, gid):
+    """
+    Recursively change the owner of a directory tree, like chown --recursive.
+
+    Args:
+        path (str): The root of the tree.
+        uid (int): The user ID.
+        gid (int): The group ID.
+    """
+    os.chown(path, uid, gid, follow_symlinks=False)
+    for (_, dir_names, file_names, dir_fd) in os.fwalk(path):
+        for name in dir_names + file_names:
+            os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
 
 def download_archlinuxarm(arch, board, dist_repo_url, output_dir, uid, gid):
     """
@@ -57,34 +143,77 @@ def download_archlinuxarm(arch, board, dist_repo_url, output_dir, uid, gid):
         _arch = 'aarch64'
     filename = os.path.join(output_dir, f'archlinuxarm-{board}-{arch}.tgz')
     url = f'{dist_repo_url}/os/ArchLinuxARM-rpi-{_arch}-latest.tar.gz'
-    response = requests.get(url)
-    with open(f'{filename}.tmp', 'wb') as file:
-        file.write(response.content)
+    with _session().get(url, headers=_IDENTITY_ENCODING, stream=True, timeout=_TIMEOUT) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        with open(f'{filename}.tmp', 'wb') as file:
+            shutil.copyfileobj(response.raw, file, length=1024 * 1024)
     os.rename(f'{filename}.tmp', f'{filename}')
-    _run(['chown', '--recursive', f'{uid}:{gid}', f'{output_dir}'])
     print(f'Downloaded: {filename}')
 
-def get_latest_image_url(url):
+def _get_index_hrefs(url, href_re, cache_dir):
+    """
+    Get the links matching a pattern from a directory index page.
+
+    The result is cached in the cache directory along with the ETag and
+    Last-Modified headers, so an unchanged index is not downloaded again.
+
+    Args:
+        url (str): The URL of the index page.
+        href_re (re.Pattern): The compiled pattern capturing the href values.
+        cache_dir (str): The cache directory for saving the index cache.
+
+    Returns:
+        list[str]: The matching hrefs in page order.
+    """
+    cache_file = os.path.join(cache_dir, f'index-{hashlib.sha1(url.encode()).hexdigest()}.json')
+    cached = None
+    try:
+        with open(cache_file) as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        pass
+
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    response = _session().get(url, headers=headers, timeout=_TIMEOUT)
+    if cached and response.status_code == 304:
+        return cached['hrefs']
+    response.raise_for_status()
+    hrefs = [href.decode() for href in href_re.findall(response.content)]
+
+    # Targets sharing an arch fetch the same index concurrently, so each writer needs its own temp file
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, prefix='index-', suffix='.tmp', delete=False) as file:
+        json.dump({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hrefs': hrefs,
+        }, file)
+    os.replace(file.name, cache_file)
+    return hrefs
+
+def get_latest_image_url(url, cache_dir):
     """
     Get the URL of the latest Raspberry Pi OS image.
 
     Args:
         url (str): The URL of the distribution repository.
+        cache_dir (str): The cache directory for saving the index cache.
 
     Returns:
         str: The URL of the latest image.
     """
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = soup.find_all('a')
-    latest_link = max(links, key=lambda link: link.text)
-    latest_image_url = urljoin(url, latest_link['href'])
+    dir_hrefs = _get_index_hrefs(url, _DIR_HREF_RE, cache_dir)
+    if not dir_hrefs:
+        raise ValueError('No image directory found in the repository URL')
+    latest_image_url = urljoin(url, max(dir_hrefs))
 
     # Get the URL for the filename ending in .xz
-    response = requests.get(latest_image_url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = soup.find_all('a')
-    xz_links = [link['href'] for link in links if link['href'].endswith('.xz')]
+    xz_links = _get_index_hrefs(latest_image_url, _XZ_HREF_RE, cache_dir)
     if not xz_links:
         raise ValueError('No .xz file found in the latest image URL')
     xz_filename = xz_links[0]
@@ -111,26 +240,77 @@ def download_rpios(arch, board, dist_repo_url, output_dir, cache_dir, uid, gid):
         _arch = 'arm64'
     filename = f'rpios-{board}-{arch}'
     img_file = os.path.join(cache_dir, f'rpios-{board}-{arch}.img')
-    xz_file = os.path.join(cache_dir, f'{filename}.xz.tmp')
     tmp_file = os.path.join(cache_dir, f'{filename}.tmp')
     
     try:
         url = urljoin(dist_repo_url, f'raspios_lite_{_arch}/images/')
-        latest_image_url = get_latest_image_url(url)
+        latest_image_url = get_latest_image_url(url, cache_dir)
+        response = _session().get(f'{latest_image_url}.sha256', timeout=_TIMEOUT)
+        response.raise_for_status()
+        expected_sha256 = response.text.split()[0].lower()
+
         print(f'Downloading: {latest_image_url}')
-        response = requests.get(latest_image_url)
-        with open(xz_file, 'wb') as file:
-            file.write(response.content)
-        
-        subprocess.run(['xzcat', xz_file], stdout=open(tmp_file, 'wb'))
-        os.remove(xz_file)
-        os.rename(tmp_file, img_file)
+        try:
+            with _session().get(latest_image_url, headers=_IDENTITY_ENCODING, stream=True, timeout=_TIMEOUT) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(tmp_file, 'wb') as file:
+                    proc = subprocess.Popen(['xz', '-d', '-c'], stdin=subprocess.PIPE, stdout=file)
+                    writer = _HashingWriter(proc.stdin)
+                    try:
+                        shutil.copyfileobj(response.raw, writer, length=1024 * 1024)
+                    except BrokenPipeError:
+                        # xz gave up on a corrupt stream, hash the rest so the checksum can be reported
+                        for chunk in iter(lambda: response.raw.read(1024 * 1024), b''):
+                            writer.hash.update(chunk)
+                    finally:
+                        try:
+                            proc.stdin.close()
+                        except BrokenPipeError:
+                            pass
+                        finally:
+                            retcode = proc.wait()
+            # A corrupted download usually breaks xz too, so report the checksum first
+            if writer.hash.hexdigest() != expected_sha256:
+                raise RuntimeError(f'SHA-256 mismatch for {latest_image_url}: {writer.hash.hexdigest()} != {expected_sha256}')
+            if retcode != 0:
+                raise RuntimeError(f'xz exited with code {retcode}')
+            os.rename(tmp_file, img_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            raise
         
         build_rpios_tgz(filename, img_file, cache_dir, output_dir, uid, gid)  # Call build_rpios_tgz function with the filename
         print(f'Image built: {filename}')
         
     except Exception as e:
         print(f'Error building {filename}: {str(e)}')
+        raise SystemExit(1)
+
+def _tar_rpios_image_kpartx(filename, img_file, tgz_file):
+    """
+    Pack the root and boot filesystems of the image into a tarball using kpartx and host mounts.
+
+    Args:
+        filename (str): The filename of the Raspberry Pi OS image.
+        img_file (str): The path to the Raspberry Pi OS image file.
+        tgz_file (str): The path of the tarball to create.
+    """
+    mount_dir = os.path.join('/mnt', filename)
+    os.makedirs(mount_dir, exist_ok=True)
+    try:
+        output = _run_capture(['kpartx', '-av', img_file])
+        lines = output.splitlines()
+        partitions = [re.search(r'add map (\S+)', line).group(1) for line in lines]
+        _run(['mount', f'/dev/mapper/{partitions[1]}', mount_dir])
+        _run(['mount', f'/dev/mapper/{partitions[0]}', f'{mount_dir}/boot/firmware'])
+        compressor = ('pigz' if shutil.which('pigz') else 'gzip')
+        _run(['tar', f'--use-compress-program={compressor}', '-cf', tgz_file, '-C', mount_dir, '.'])
+        _run(['umount', f'{mount_dir}/boot/firmware', mount_dir])
+        _run(['kpartx', '-d', img_file])
+    finally:
+        os.rmdir(mount_dir)
 
 def build_rpios_tgz(filename, img_file, cache_dir, output_dir, uid, gid):
     """
@@ -142,24 +322,30 @@ def build_rpios_tgz(filename, img_file, cache_dir, output_dir, uid, gid):
         cache_dir (str): The cache directory for temporary files.
         output_dir (str): The output directory for saving the compressed tarball.
     """
-    os.makedirs('/mnt/rpios', exist_ok=True)
     try:
-        output = _run(['kpartx', '-av', img_file], read=True)
-        lines = output.splitlines()
-        partitions = [re.search(r'add map (\S+)', line).group(1) for line in lines]
-        _run(['mount', f'/dev/mapper/{partitions[1]}', '/mnt/rpios'])
-        _run(['mount', f'/dev/mapper/{partitions[0]}', '/mnt/rpios/boot/firmware'])
-        _run(['tar', '-czf', f'{img_file}.tmp', '-C', '/mnt/rpios', '.'])
-        _run(['chown', f'{os.getuid()}:{os.getgid()}', f'{img_file}.tmp'])
-        _run(['mv', f'{img_file}.tmp', f'{output_dir}/{filename}.tgz'])
-        _run(['chown', '--recursive', f'{uid}:{gid}', f'{output_dir}'])
-        _run(['umount', '/mnt/rpios/boot/firmware'])
-        _run(['umount', '/mnt/rpios'])
-        _run(['kpartx', '-d', img_file])
+        _tar_rpios_image_kpartx(filename, img_file, f'{img_file}.tmp')
+        shutil.move(f'{img_file}.tmp', f'{output_dir}/{filename}.tgz')
         print(f'Compressed tarball created: {filename}')
     finally:
-        _run(['rm', f'{img_file}'])
-        _run(['rmdir', '/mnt/rpios'])
+        os.unlink(img_file)
+
+def _parse_target(value: str) -> tuple[str, str]:
+    """
+    Parse a target specification in the form arch:board.
+
+    Args:
+        value (str): The target specification.
+
+    Returns:
+        tuple[str, str]: The architecture and board.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not in the form arch:board.
+    """
+    (arch, sep, board) = value.partition(':')
+    if not sep or not arch or not board:
+        raise argparse.ArgumentTypeError(f'Invalid target {value!r}, expected arch:board')
+    return (arch, board)
 
 def main() -> None:
     """
@@ -170,19 +356,33 @@ def main() -> None:
     parser.add_argument('--os-repo-url', type=str, help='The URL of the distribution repository')
     parser.add_argument('--arch', type=str, help='CPU architecture (arm or aarch64)')
     parser.add_argument('--board', type=str, help='Raspberry Pi board type (rpi2, rpi3, rpi4, etc)')
+    parser.add_argument('--target', type=_parse_target, action='append', default=[],
+                        help='Architecture and board pair as arch:board (may be repeated, overrides --arch/--board)')
     parser.add_argument('--output-dir', default='/root/base', help='Output directory for saving the image')
     parser.add_argument('--cache-dir', default='/root/.cache', help='Cache directory for saving temporary files')
-    parser.add_argument('--uid', type=int, help='User ID for the output directory')
-    parser.add_argument('--gid', type=int, help='Group ID for the output directory')
+    parser.add_argument('--uid', type=int, required=True, help='User ID for the output directory')
+    parser.add_argument('--gid', type=int, required=True, help='Group ID for the output directory')
     parser.set_defaults(log_level=logging.INFO)
 
     options = parser.parse_args()
     logging.basicConfig(level=options.log_level, format="%(message)s")
 
-    if options.os == 'rpios':
-        download_rpios(options.arch, options.board, options.os_repo_url, options.output_dir, options.cache_dir, options.uid, options.gid)
-    elif options.os == 'archlinuxarm':
-        download_archlinuxarm(options.arch, options.board, options.os_repo_url, options.output_dir, options.uid, options.gid)
+    targets = (options.target or [(options.arch, options.board)])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(targets))) as executor:
+        futures = []
+        for (arch, board) in targets:
+            if options.os == 'rpios':
+                futures.append(executor.submit(download_rpios, arch, board, options.os_repo_url, options.output_dir, options.cache_dir, options.uid, options.gid))
+            elif options.os == 'archlinuxarm':
+                futures.append(executor.submit(download_archlinuxarm, arch, board, options.os_repo_url, options.output_dir, options.uid, options.gid))
+        concurrent.futures.wait(futures)
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        # Chown once all the workers are done, so no sibling download renames files under the walk
+        if any(future.exception() is None for future in futures):
+            _chown_tree(options.output_dir, options.uid, options.gid)
 
 if __name__ == "__main__":
     main()